@@ -0,0 +1,92 @@
+import numpy as np
+from numba import prange
+import os
+import inspect
+import hashlib
+
+""" 
+Numba kernels used by piece_image_generator.py.
+
+Running this script compiles them ahead of time into the extension
+module blend_kernels (next to this file), which piece_image_generator.py
+then imports instead of compiling the kernels at every run. The
+extension module records a hash of the kernel sources and signatures
+(KERNEL_HASH), piece_image_generator.py ignores it when it is stale.
+NB: the ahead-of-time compiled kernels run on a single core, and
+numba.pycc emits a NumbaPendingDeprecationWarning while compiling
+since it is pending deprecation (it still works with the pinned numba).
+"""
+####################### kernel signatures #######################
+
+BLEND_BATCH_SIGNATURE = 'void(u1[:,:,:,::1], u1[:,:,:,:,::1], i8[::1], i8[::1], i8[::1], u1[:,:,:,::1])'
+
+####################### superimpose pieces on squares #######################
+
+def blend_batch(squares, pieces, square_idx, set_idx, class_idx, out):
+    '''
+    Function that alpha blends a batch of piece images on top
+    of a batch of empty square images. The tiles are read straight
+    from the square and piece caches instead of being gathered
+    first.
+
+    Parameters
+    ----------
+    squares: uint8 array with shape = (n_squares,50,50,3)
+        RGB empty squares (background), see load_empty_squares in piece_image_generator.py.
+    pieces: uint8 array with shape = (n_sets,13,50,50,4)
+        RGBA pieces (foreground), see load_pieces in piece_image_generator.py.
+    square_idx, set_idx, class_idx: int64 arrays with shape = (N,)
+        Image n is pieces[set_idx[n],class_idx[n]] placed on
+        squares[square_idx[n]].
+    out: uint8 array with shape = (N,50,50,3)
+        Buffer where the resulting RGB images are written. The
+        piece alpha is only used for blending, it is not kept.
+
+    Returns
+    -------
+    None
+    '''
+
+    for n in prange(out.shape[0]):
+        bg = squares[square_idx[n]]
+        fg = pieces[set_idx[n], class_idx[n]]
+        for y in range(out.shape[1]):
+            for x in range(out.shape[2]):
+                a = np.uint32(fg[y,x,3])
+                # most piece pixels are either fully transparent
+                # or fully opaque, copy those without blending
+                if a == 0:
+                    for c in range(3):
+                        out[n,y,x,c] = bg[y,x,c]
+                elif a == 255:
+                    for c in range(3):
+                        out[n,y,x,c] = fg[y,x,c]
+                else:
+                    for c in range(3):
+                        v = np.uint32(fg[y,x,c])*a + np.uint32(bg[y,x,c])*(255-a)
+                        # divide by 255 with rounding
+                        out[n,y,x,c] = ((v + 128)*257) >> 16
+
+####################### kernel version #######################
+
+# 60-bit hash of the kernel source and signature, fits in an int64.
+# Compiled into blend_kernels, so that a module built from an older
+# version of the kernel can be detected
+KERNEL_HASH = int(hashlib.sha256(
+    (inspect.getsource(blend_batch) + BLEND_BATCH_SIGNATURE).encode()
+).hexdigest()[:15], 16)
+
+####################### ahead-of-time compilation #######################
+
+if __name__ == "__main__":
+    from numba.pycc import CC
+
+    cc = CC('blend_kernels')
+    cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+    cc.export('blend_batch', BLEND_BATCH_SIGNATURE)(blend_batch)
+
+    # KERNEL_HASH is a global, numba freezes it into the compiled function
+    def kernel_hash():
+        return KERNEL_HASH
+    cc.export('kernel_hash', 'i8()')(kernel_hash)
+    cc.compile()